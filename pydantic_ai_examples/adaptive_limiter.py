@@ -0,0 +1,223 @@
+"""レート制限のあるAPIへの同時リクエスト数を、AIMDで自動調整するリミッター。
+
+固定の`asyncio.Semaphore`では、上限が低すぎると処理能力を無駄にし、高すぎると
+429エラーが連鎖します。`AdaptiveLimiter`はTCPの輻輳制御と同じように、レイテンシが
+健全な間は同時実行数を少しずつ増やし（加算増加）、429や5xxが返ると半分に減らします
+（乗算減少）。`Retry-After`ヘッダーがあれば、その間は新しいリクエストを送りません。
+
+他の非同期の例でも、API呼び出しを`run`で包むだけで使えます:
+
+    limiter = AdaptiveLimiter(name='embeddings')
+    response = await limiter.run(
+        lambda: openai.embeddings.create(input=texts, model=model)
+    )
+
+OpenAIのクライアントは自身でも429を再試行するので、`AsyncOpenAI(max_retries=0)`として
+再試行をリミッターに任せてください。接続の失敗やタイムアウトも、同時実行数は下げずに
+そのリクエストだけ指数バックオフで再試行します。
+"""
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import random
+import time
+from collections.abc import Awaitable, Callable
+from email.utils import parsedate_to_datetime
+from typing import Any, TypeVar
+
+import httpx
+import logfire
+import openai
+
+T = TypeVar('T')
+
+
+class AdaptiveLimiter:
+    """AIMD（加算増加・乗算減少）で同時実行数を調整するリミッター。
+
+    成功したリクエストのレイテンシが、これまでの最小値の`latency_tolerance`倍以内なら、
+    同時実行数を1リクエストごとに`1 / limit`ずつ（1ウィンドウ分の成功で1つ）増やします。
+    429や5xxのエラーでは同時実行数を`backoff`倍にし、`Retry-After`の秒数
+    （なければ指数バックオフ）だけ待ってから再試行します。
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        backoff: float = 0.5,
+        latency_tolerance: float = 2.0,
+        max_retries: int = 8,
+        log_interval: float = 10.0,
+        name: str = 'limiter',
+    ) -> None:
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.max_retries = max_retries
+        self.log_interval = log_interval
+        self.name = name
+        self.completed = 0
+        self.throttled = 0
+        self.transient_errors = 0
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        # この時刻まではRetry-Afterに従って新しいリクエストを送りません
+        self._blocked_until = 0.0
+        self._last_backoff = 0.0
+        self._latency: float | None = None
+        self._min_latency: float | None = None
+        self._started = time.monotonic()
+        self._logged_at = self._started
+        self._logged_completed = 0
+
+    async def run(self, call: Callable[[], Awaitable[T]]) -> T:
+        """`call`を同時実行数の範囲内で呼び出し、過負荷のエラーなら再試行します。"""
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            start = time.monotonic()
+            retry_delay = 0.0
+            try:
+                result = await call()
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = overload_delay(e)
+                if delay is not None:
+                    self._on_overload(delay or _backoff_delay(attempt), e)
+                elif is_transient(e):
+                    # 過負荷とは限らないので、同時実行数は下げず、
+                    # このリクエストだけ待ちます
+                    self.transient_errors += 1
+                    retry_delay = _backoff_delay(attempt)
+                    logfire.warn(
+                        '{name}: 接続エラーのため{delay:.1f}秒後に再試行します',
+                        name=self.name,
+                        delay=retry_delay,
+                        error=repr(e),
+                    )
+                else:
+                    raise
+            else:
+                self._on_success(time.monotonic() - start)
+                return result
+            finally:
+                # キャンセル（BaseException）でも枠を返します
+                await self._release()
+            await asyncio.sleep(retry_delay)
+        raise AssertionError('unreachable')
+
+    def stats(self) -> dict[str, Any]:
+        elapsed = time.monotonic() - self._started
+        return {
+            f'{self.name}_limit': round(self.limit, 2),
+            f'{self.name}_in_flight': self._in_flight,
+            f'{self.name}_completed': self.completed,
+            f'{self.name}_throttled': self.throttled,
+            f'{self.name}_transient_errors': self.transient_errors,
+            f'{self.name}_throughput': self.completed / elapsed if elapsed else 0.0,
+        }
+
+    async def _acquire(self) -> None:
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(
+                    lambda: self._in_flight < max(int(self.limit), 1)
+                )
+                delay = self._blocked_until - time.monotonic()
+                if delay <= 0:
+                    self._in_flight += 1
+                    return
+            await asyncio.sleep(delay)
+
+    async def _release(self) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+        self._maybe_log()
+
+    def _on_success(self, latency: float) -> None:
+        self.completed += 1
+        self._latency = (
+            latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+        )
+        self._min_latency = min(self._min_latency or latency, latency)
+        if latency <= self._min_latency * self.latency_tolerance:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def _on_overload(self, delay: float, error: Exception) -> None:
+        self.throttled += 1
+        now = time.monotonic()
+        self._blocked_until = max(self._blocked_until, now + delay)
+        # 同じ過負荷で同時に失敗したリクエストごとに何度も減らさないよう、
+        # 減らすのはレイテンシ1回分の間に1度だけにします
+        if now - self._last_backoff > (self._latency or 0.0):
+            self._last_backoff = now
+            self.limit = max(self.limit * self.backoff, self.min_limit)
+            logfire.warn(
+                '{name}: 過負荷のため同時実行数を{limit:.1f}に下げます',
+                name=self.name,
+                limit=self.limit,
+                delay=delay,
+                error=str(error),
+            )
+
+    def _maybe_log(self) -> None:
+        now = time.monotonic()
+        if now - self._logged_at < self.log_interval:
+            return
+        throughput = (self.completed - self._logged_completed) / (now - self._logged_at)
+        self._logged_at, self._logged_completed = now, self.completed
+        logfire.info(
+            '{name}: 同時実行数 {limit:.1f}, スループット {throughput:.1f} req/s',
+            name=self.name,
+            limit=self.limit,
+            throughput=throughput,
+            throttled=self.throttled,
+        )
+
+
+def overload_delay(error: BaseException) -> float | None:
+    """過負荷（429か5xx）のエラーなら待つべき秒数を返し、それ以外はNoneを返します。
+
+    `Retry-After`（または`retry-after-ms`）ヘッダーがなければ0を返します。
+    OpenAIの`APIStatusError`も`httpx.HTTPStatusError`も、`response`属性に
+    `httpx.Response`を持つので、どちらにも使えます。
+    """
+    response = getattr(error, 'response', None)
+    if not isinstance(response, httpx.Response):
+        return None
+    if response.status_code != 429 and response.status_code < 500:
+        return None
+    headers = response.headers
+    if (value := headers.get('retry-after-ms')) is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    if (value := headers.get('retry-after')) is not None:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    return 0.0
+
+
+def is_transient(error: BaseException) -> bool:
+    """接続の失敗やタイムアウトのような、レスポンスのない一時的なエラーかどうか。
+
+    OpenAIの`APITimeoutError`は`APIConnectionError`のサブクラスです。
+    """
+    return isinstance(error, (httpx.TransportError, openai.APIConnectionError))
+
+
+def _backoff_delay(attempt: int) -> float:
+    # Retry-Afterがないときの、ジッター付きの指数バックオフ
+    return min(0.5 * 2**attempt, 30.0) * random.uniform(0.5, 1.0)
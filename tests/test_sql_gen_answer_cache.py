@@ -0,0 +1,80 @@
+"""`sql_gen.AnswerCache`の、言い換えた質問の判定のテスト。
+
+`pytest tests`で実行します（データベースやAPIには接続しません）。
+"""
+
+import os
+from datetime import date
+
+import pytest
+
+# sql_genはimport時にAgentを作るので、APIキーが必要です
+os.environ.setdefault('GEMINI_API_KEY', 'test')
+
+from pydantic_ai_examples.sql_gen import AnswerCache, Success  # noqa: E402
+
+TODAY = date(2024, 1, 2)
+SCHEMA_VERSION = 'test'
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = AnswerCache(tmp_path / 'answers.sqlite')
+    yield cache
+    cache.close()
+
+
+def put(cache: AnswerCache, prompt: str) -> Success:
+    result = Success(sql_query='select * from records', explanation=prompt)
+    cache.put(prompt, result, TODAY, SCHEMA_VERSION)
+    return result
+
+
+@pytest.mark.parametrize(
+    'cached, prompt',
+    [
+        (
+            'show me error logs from yesterday',
+            'show me the error logs from yesterday',
+        ),
+        ('show me error logs from yesterday', 'show error logs from yesterday'),
+        ('show me error logs from yesterday', 'show me error log from yesterday'),
+        ('show me error logs from yesterday', 'Show me error logs from yesterday?'),
+        ('昨日のエラーレベルのログを表示して', '昨日のエラーレベルのログを見せて'),
+        (
+            '昨日のエラーレベルのログを表示して',
+            '昨日のエラーレベルのログを表示してください',
+        ),
+    ],
+)
+def test_rewording_hits(cache: AnswerCache, cached: str, prompt: str):
+    result = put(cache, cached)
+    assert cache.get(prompt, TODAY, SCHEMA_VERSION) == result
+
+
+@pytest.mark.parametrize(
+    'cached, prompt',
+    [
+        ('show me error logs from yesterday', 'show me error logs from today'),
+        ('show me error logs from yesterday', 'show me warning logs from yesterday'),
+        ('show me error logs from yesterday', 'show me logs from yesterday'),
+        ('show me error logs from yesterday', 'show me error logs not from yesterday'),
+        ('show me error logs from yesterday', 'count error logs from yesterday'),
+        ('show me logs from the last 3 days', 'show me logs from the last 7 days'),
+        ("show me logs tagged 'foo'", "show me logs tagged 'bar'"),
+        ('昨日のエラーレベルのログを表示して', '今日のエラーレベルのログを表示して'),
+        ('昨日のエラーレベルのログを表示して', '先週のエラーレベルのログを表示して'),
+        ('昨日のエラーレベルのログを表示して', '昨日の警告レベルのログを表示して'),
+        (
+            '昨日のエラーレベルのログを表示して',
+            '昨日のエラーレベル以外のログを表示して',
+        ),
+        (
+            '昨日のエラーレベルのログを表示して',
+            '昨日のエラーレベルのトレースを表示して',
+        ),
+    ],
+)
+def test_different_question_misses(cache: AnswerCache, cached: str, prompt: str):
+    put(cache, cached)
+    assert cache.get(prompt, TODAY, SCHEMA_VERSION) is None